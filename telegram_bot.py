@@ -1,15 +1,27 @@
+import aiosqlite
+import asyncio
+import ciso8601
+import httpx
 import openai
+from openai import APIConnectionError, APITimeoutError, RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from dotenv import load_dotenv
+import functools
 import os
 from datetime import datetime
 import pytz
-import uuid
+import secrets
 import json
+import atexit
 import logging
+import logging.handlers
+import queue
+import unicodedata
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
 from telegram.ext import (
+    AIORateLimiter,
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
@@ -17,65 +29,256 @@ from telegram.ext import (
     ContextTypes,
     filters,
     ConversationHandler,
+    InvalidCallbackData,
 )
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler("bot.log"),
-        logging.StreamHandler()
-    ]
-)
+# Настройка логирования: обработчики кладут записи в очередь, а дисковый
+# ввод-вывод выполняет фоновый поток QueueListener, не блокируя event loop
+_log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_log_file_handler = logging.FileHandler("bot.log")
+_log_file_handler.setFormatter(_log_formatter)
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(_log_formatter)
+
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_file_handler, _log_stream_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+_root_logger = logging.getLogger()
+_root_logger.setLevel(logging.INFO)
+_root_logger.addHandler(logging.handlers.QueueHandler(_log_queue))
 logger = logging.getLogger(__name__)
 
 # Загрузка переменных из .env файла
 load_dotenv()
 
-# Устанавливаем API-ключ OpenAI
-openai.api_key = os.getenv('OPENAI_API_KEY')
+# Общий асинхронный клиент OpenAI (создаём один раз и переиспользуем).
+# HTTP/2 мультиплексирует параллельные запросы по одному соединению,
+# а пул keep-alive избавляет от TLS-рукопожатия на каждый вызов
+_http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    timeout=httpx.Timeout(30.0, connect=5.0),
+)
+client = openai.AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), http_client=_http_client)
+
+# Ограничитель одновременных запросов к GPT, чтобы не упираться в лимиты OpenAI
+_GPT_SEM = asyncio.Semaphore(int(os.getenv('GPT_CONCURRENCY', '20')))
+
+# Запрос к GPT с повторами при временных сбоях (rate limit, сеть, таймаут);
+# логические ошибки не повторяются
+@retry(
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, APITimeoutError)),
+    wait=wait_exponential(min=1, max=16),
+    stop=stop_after_attempt(3),
+    reraise=True,
+)
+async def _chat_completion(**kwargs):
+    async with _GPT_SEM:
+        return await client.chat.completions.create(**kwargs)
 
 # Определение состояний для ConversationHandler
 ASK_CITY = 1
 POST_TIMEZONE_SET = 2
 CHANGE_TIMEZONE = 3
 
-# Хранилище задач: {user_id: {task_id: {'description': str, 'time': datetime, 'job': Job}}}
-user_tasks = {}
+# Путь к базе задач: SQLite переживает перезапуски, в отличие от dict в памяти
+DB_PATH = os.getenv('DB_PATH', 'tasks.db')
+
+# Соединение aiosqlite, открывается в init_db при старте приложения
+db = None
+
+# Прямая карта task_id -> Job: отмена напоминания за O(1) вместо
+# сканирования очереди через get_jobs_by_name
+_jobs = {}
+
+# Инициализация базы и восстановление напоминаний после перезапуска
+async def init_db(application):
+    global db
+    db = await aiosqlite.connect(DB_PATH)
+    await db.execute('PRAGMA journal_mode=WAL')
+    await db.execute(
+        'CREATE TABLE IF NOT EXISTS tasks ('
+        'user_id INTEGER NOT NULL, '
+        'task_id TEXT NOT NULL, '
+        'description TEXT NOT NULL, '
+        'time_utc_epoch INTEGER NOT NULL, '
+        "tz TEXT NOT NULL DEFAULT 'UTC', "
+        'PRIMARY KEY (user_id, task_id))'
+    )
+    # Добавляем колонку tz в базы, созданные до её появления
+    try:
+        await db.execute("ALTER TABLE tasks ADD COLUMN tz TEXT NOT NULL DEFAULT 'UTC'")
+    except aiosqlite.OperationalError:
+        pass
+    # Индекс по времени, чтобы выборка задач приходила уже отсортированной
+    await db.execute(
+        'CREATE INDEX IF NOT EXISTS idx_tasks_user_time ON tasks (user_id, time_utc_epoch)'
+    )
+    await db.commit()
+
+    # Перепланируем задачи с временем в будущем; просроченные удаляем
+    now_epoch = int(datetime.now(UTC).timestamp())
+    async with db.execute('SELECT user_id, task_id, time_utc_epoch FROM tasks') as cursor:
+        rows = await cursor.fetchall()
+    restored = 0
+    for user_id, task_id, epoch in rows:
+        if epoch > now_epoch:
+            _jobs[task_id] = application.job_queue.run_once(
+                send_reminder,
+                when=datetime.fromtimestamp(epoch, UTC),
+                data={'user_id': user_id, 'task_id': task_id},
+                name=task_id,
+                user_id=user_id
+            )
+            restored += 1
+        else:
+            await db.execute('DELETE FROM tasks WHERE user_id = ? AND task_id = ?', (user_id, task_id))
+    await db.commit()
+    logger.info(f"База задач инициализирована, восстановлено напоминаний: {restored}")
+
+# Закрытие соединения с базой при остановке бота
+async def close_db(application):
+    if db is not None:
+        await db.close()
+
+# Добавление задачи в базу (tz — часовой пояс пользователя на момент создания,
+# используется для отображения, если текущий пояс неизвестен)
+async def db_add_task(user_id, task_id, description, time_utc_epoch, tz):
+    await db.execute(
+        'INSERT INTO tasks (user_id, task_id, description, time_utc_epoch, tz) VALUES (?, ?, ?, ?, ?)',
+        (user_id, task_id, description, time_utc_epoch, tz)
+    )
+    await db.commit()
+
+# Получение всех задач пользователя (от ближайших к самым дальним)
+async def db_get_tasks(user_id):
+    async with db.execute(
+        'SELECT task_id, description, time_utc_epoch FROM tasks '
+        'WHERE user_id = ? ORDER BY time_utc_epoch',
+        (user_id,)
+    ) as cursor:
+        return await cursor.fetchall()
+
+# Получение одной задачи пользователя
+async def db_get_task(user_id, task_id):
+    async with db.execute(
+        'SELECT task_id, description, time_utc_epoch, tz FROM tasks WHERE user_id = ? AND task_id = ?',
+        (user_id, task_id)
+    ) as cursor:
+        return await cursor.fetchone()
+
+# Удаление задачи из базы
+async def db_delete_task(user_id, task_id):
+    await db.execute('DELETE FROM tasks WHERE user_id = ? AND task_id = ?', (user_id, task_id))
+    await db.commit()
+
+# UTC как константа, чтобы не обращаться к pytz на каждом сообщении
+UTC = pytz.utc
+
+# Множество всех часовых поясов для проверки за O(1) вместо перебора списка
+_ALL_TZ = frozenset(pytz.all_timezones)
+
+# Шаблоны системных промптов собираются один раз; при вызове подставляются только переменные части
+_TZ_SYS_TMPL = (
+    "Ты помощник, который может определить часовой пояс по названию города. "
+    "Название города может содержать опечатки или быть написано с ошибками. "
+    "Текущее время: {now} (формат: YYYY-MM-DD HH:MM:SS). "
+    "Пользователь ввёл название города: {city}. "
+    "Определи наиболее вероятный часовой пояс этого города и верни его в формате строки, например 'Europe/Moscow'. "
+    "Если город не найден или не существует, верни 'Unknown'."
+)
+
+_TASK_SYS_TMPL = (
+    "Ты Telegram-бот, созданный Радомиром Брызгаловым. Твоя задача — извлечь из пользовательского сообщения описание задачи и время напоминания. "
+    "Текущее время пользователя: {now} (формат: YYYY-MM-DD HH:MM:SS). "
+    "Если время указано относительно текущего времени (например, 'через 5 мин'), рассчитай абсолютное время. "
+    "Верни результат в формате JSON: {{\"task\": \"описание задачи\", \"time\": \"время в формате YYYY-MM-DD HH:MM:SS\"}}."
+)
+
+# Схема ответа для Structured Outputs: модель гарантированно возвращает валидный JSON
+_TASK_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "task_time",
+        "schema": {
+            "type": "object",
+            "properties": {
+                "task": {"type": "string"},
+                "time": {"type": "string", "pattern": "^\\d{4}-\\d{2}-\\d{2} \\d{2}:\\d{2}:\\d{2}$"},
+            },
+            "required": ["task", "time"],
+        },
+    },
+}
+
+# Кэш объектов часовых поясов: pytz.timezone парсит файл tz-базы при каждом вызове
+@functools.lru_cache(maxsize=512)
+def _tz(name: str):
+    return pytz.timezone(name)
+
+# Формат 'YYYY-MM-DD HH:MM:SS' через f-строку: быстрее strftime, который
+# проходит через локале-зависимый C-форматтер
+def _fast_iso(dt: datetime) -> str:
+    return f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d} {dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}"
+
+# Кэш форматирования времени с точностью до секунды: под нагрузкой одна и та же
+# секунда форматируется многократно
+@functools.lru_cache(maxsize=4096)
+def _fmt_ymdhms(epoch: int, tz: str) -> str:
+    return _fast_iso(datetime.fromtimestamp(epoch, _tz(tz)))
+
+def _fmt_dt(dt: datetime) -> str:
+    return _fmt_ymdhms(int(dt.timestamp()), dt.tzinfo.zone)
+
+# Кэш город -> часовой пояс: пользователи концентрируются на одних и тех же
+# городах, поэтому повторные запросы обходятся без GPT
+_city_to_tz = {}
+_city_to_tz_lock = asyncio.Lock()
+
+# Определение часового пояса по городу с кэшированием нормализованного названия
+async def get_timezone_for_city(city, current_time):
+    norm = unicodedata.normalize('NFKC', city).casefold().strip()
+    async with _city_to_tz_lock:
+        cached = _city_to_tz.get(norm)
+    if cached:
+        return cached
+
+    timezone_str = await get_timezone_via_gpt(city, current_time)
+    if timezone_str:
+        async with _city_to_tz_lock:
+            _city_to_tz[norm] = timezone_str
+    return timezone_str
 
 # Функция для общения с GPT через новый API для получения часового пояса
-def get_timezone_via_gpt(city, current_time):
+async def get_timezone_via_gpt(city, current_time):
     try:
         system_message = {
             "role": "system",
-            "content": (
-                "Ты помощник, который может определить часовой пояс по названию города. "
-                "Название города может содержать опечатки или быть написано с ошибками. "
-                f"Текущее время: {current_time.strftime('%Y-%m-%d %H:%M:%S')} (формат: YYYY-MM-DD HH:MM:SS). "
-                f"Пользователь ввёл название города: {city}. "
-                "Определи наиболее вероятный часовой пояс этого города и верни его в формате строки, например 'Europe/Moscow'. "
-                "Если город не найден или не существует, верни 'Unknown'."
+            "content": _TZ_SYS_TMPL.format(
+                now=_fmt_dt(current_time),
+                city=city
             )
         }
         user_message = {
             "role": "user",
             "content": city
         }
-        response = openai.ChatCompletion.create(
+        response = await _chat_completion(
             model="gpt-3.5-turbo",
             messages=[system_message, user_message],
             max_tokens=50,
             temperature=0.0
         )
-        content = response['choices'][0]['message']['content'].strip()
+        content = response.choices[0].message.content.strip()
         logger.info(f"GPT ответ на запрос часового пояса для города '{city}': '{content}'")
 
         # Убираем возможные кавычки и лишние символы
         timezone = content.strip('"').strip("'").strip()
 
         # Проверяем, что часовой пояс валиден
-        if timezone in pytz.all_timezones:
+        if timezone in _ALL_TZ:
             return timezone
         else:
             logger.warning(f"Получен неизвестный часовой пояс: '{timezone}'")
@@ -85,53 +288,50 @@ def get_timezone_via_gpt(city, current_time):
         return None
 
 # Функция для общения с GPT через новый API для извлечения задачи и времени
-def extract_task_and_time(prompt, current_time):
+async def extract_task_and_time(prompt, current_time):
     try:
         system_message = {
             "role": "system",
-            "content": (
-                "Ты Telegram-бот, созданный Радомиром Брызгаловым. Твоя задача — извлечь из пользовательского сообщения описание задачи и время напоминания. "
-                f"Текущее время пользователя: {current_time.strftime('%Y-%m-%d %H:%M:%S')} (формат: YYYY-MM-DD HH:MM:SS). "
-                "Если время указано относительно текущего времени (например, 'через 5 мин'), рассчитай абсолютное время. "
-                "Верни результат в формате JSON: {\"task\": \"описание задачи\", \"time\": \"время в формате YYYY-MM-DD HH:MM:SS\"}."
+            "content": _TASK_SYS_TMPL.format(
+                now=_fmt_dt(current_time)
             )
         }
         user_message = {
             "role": "user",
             "content": prompt
         }
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
+        response = await _chat_completion(
+            model="gpt-4o-mini",
             messages=[system_message, user_message],
             max_tokens=150,
-            temperature=0.3
+            temperature=0.3,
+            response_format=_TASK_RESPONSE_FORMAT
         )
-        content = response['choices'][0]['message']['content'].strip()
+        content = response.choices[0].message.content.strip()
         logger.info(f"GPT ответ на запрос задачи и времени: '{content}'")
-        # Попытка парсинга JSON из ответа
+        # Благодаря json_schema ответ гарантированно является валидным JSON
         result = json.loads(content)
         return result.get('task'), result.get('time')
-    except json.JSONDecodeError as e:
-        logger.error(f"Ошибка при парсинге JSON: {e}")
-        logger.error(f"Не удалось распарсить содержимое: '{content}'")
-        return None, None
     except Exception as e:
         logger.error(f"Ошибка при извлечении задачи и времени: {e}")
         return None, None
 
+# Текст инструкций общий для send_instructions и button_handler,
+# поэтому собирается один раз при импорте
+_INSTRUCTIONS = (
+    "📋 <b>Инструкции по использованию бота:</b>\n\n"
+    "1. <b>Добавление задачи:</b> Напишите любую задачу вместе со временем, когда нужно напомнить. Пример: 'Встреча с командой завтра в 15:00' или 'Пробежка через час'.\n"
+    "2. <b>Просмотр задач:</b> Нажмите кнопку '📋 Просмотреть задачи', чтобы увидеть все свои запланированные задачи.\n"
+    "3. <b>Удаление задачи:</b> Нажмите кнопку '🗑 Удалить задачу' и выберите задачу, которую хотите удалить.\n"
+    "4. <b>Дополнительные настройки:</b> В разделе '➕ Ещё' вы можете изменить свой часовой пояс или снова просмотреть инструкции.\n\n"
+)
+
 # Функция для отправки инструкций
 async def send_instructions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    instructions = (
-        "📋 <b>Инструкции по использованию бота:</b>\n\n"
-        "1. <b>Добавление задачи:</b> Напишите любую задачу вместе со временем, когда нужно напомнить. Пример: 'Встреча с командой завтра в 15:00' или 'Пробежка через час'.\n"
-        "2. <b>Просмотр задач:</b> Нажмите кнопку '📋 Просмотреть задачи', чтобы увидеть все свои запланированные задачи.\n"
-        "3. <b>Удаление задачи:</b> Нажмите кнопку '🗑 Удалить задачу' и выберите задачу, которую хотите удалить.\n"
-        "4. <b>Дополнительные настройки:</b> В разделе '➕ Ещё' вы можете изменить свой часовой пояс или снова просмотреть инструкции.\n\n"
-    )
     await query.message.reply_text(
-        instructions,
+        _INSTRUCTIONS,
         parse_mode=ParseMode.HTML,
         reply_markup=main_menu()
     )
@@ -159,30 +359,34 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🌍 В каком городе вы находитесь?")
     return ASK_CITY
 
+# Клавиатуры неизменны, поэтому собираются один раз при импорте
+_POST_TIMEZONE_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📄 Инструкции", callback_data='instructions')],
+    [InlineKeyboardButton("🚀 Начать сразу", callback_data='start_now')]
+])
+
+_MAIN_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📋 Просмотреть задачи", callback_data='view_tasks')],
+    [InlineKeyboardButton("🗑 Удалить задачу", callback_data='delete_task')],
+    [InlineKeyboardButton("➕ Ещё", callback_data='more')],
+])
+
+_MORE_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📄 Инструкции", callback_data='instructions')],
+    [InlineKeyboardButton("🔄 Изменить часовой пояс", callback_data='change_timezone')],
+])
+
 # Меню после установки часового пояса
 def post_timezone_menu():
-    keyboard = [
-        [InlineKeyboardButton("📄 Инструкции", callback_data='instructions')],
-        [InlineKeyboardButton("🚀 Начать сразу", callback_data='start_now')]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return _POST_TIMEZONE_MENU
 
 # Меню основного интерфейса
 def main_menu():
-    keyboard = [
-        [InlineKeyboardButton("📋 Просмотреть задачи", callback_data='view_tasks')],
-        [InlineKeyboardButton("🗑 Удалить задачу", callback_data='delete_task')],
-        [InlineKeyboardButton("➕ Ещё", callback_data='more')],
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return _MAIN_MENU
 
 # Меню "ещё"
 def more_menu():
-    keyboard = [
-        [InlineKeyboardButton("📄 Инструкции", callback_data='instructions')],
-        [InlineKeyboardButton("🔄 Изменить часовой пояс", callback_data='change_timezone')],
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return _MORE_MENU
 
 # Обработка ответа пользователя на вопрос о городе
 async def receive_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -191,9 +395,9 @@ async def receive_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"Пользователь {user_id} указал город: {city}")
 
     # Текущее время в UTC для GPT
-    now = datetime.now(pytz.utc)
-    # Получаем часовой пояс через GPT
-    timezone_str = get_timezone_via_gpt(city, now)
+    now = datetime.now(UTC)
+    # Получаем часовой пояс из кэша либо через GPT
+    timezone_str = await get_timezone_for_city(city, now)
 
     if not timezone_str:
         await update.message.reply_text(
@@ -204,32 +408,12 @@ async def receive_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ASK_CITY
 
-    # Сохраняем часовой пояс в user_data
-    previous_timezone = context.user_data.get('timezone')
+    # Сохраняем часовой пояс в user_data; время задач хранится в UTC,
+    # поэтому существующие напоминания перепланировать не нужно —
+    # новый пояс применяется только при отображении
     context.user_data['timezone'] = timezone_str
     logger.info(f"Пользователь {user_id} установлен в часовом поясе: {timezone_str}")
 
-    # Если часовой пояс изменился, обновляем время задач
-    if previous_timezone and previous_timezone != timezone_str:
-        new_timezone = pytz.timezone(timezone_str)
-        old_timezone = pytz.timezone(previous_timezone)
-        tasks = user_tasks.get(user_id, {})
-        for task in tasks.values():
-            # Конвертируем время задачи из старого часового пояса в новый
-            task_time_utc = task['time'].astimezone(pytz.utc)
-            task['time'] = task_time_utc.astimezone(new_timezone)
-            # Пересоздаём напоминание с новым временем
-            current_jobs = context.job_queue.get_jobs_by_name(task['id'])
-            for job in current_jobs:
-                job.schedule_removal()
-            context.job_queue.run_once(
-                send_reminder,
-                when=(task['time'] - datetime.now(new_timezone)).total_seconds(),
-                data={'user_id': user_id, 'task_id': task['id']},
-                name=task['id']
-            )
-        logger.info(f"Время задач пользователя {user_id} обновлено согласно новому часовому поясу.")
-
     # Подтверждение пользователю и выбор инструкций или начать сразу
     confirmation_message = (
         f"✅ Часовой пояс успешно установлен: {timezone_str}.\n"
@@ -267,31 +451,31 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = query.from_user.id
 
     if query.data == 'view_tasks':
-        tasks = user_tasks.get(user_id, {})
+        tasks = await db_get_tasks(user_id)
         if not tasks:
             await query.message.reply_text("📭 У вас нет запланированных задач.", reply_markup=main_menu())
             return
 
-        # Сортировка задач по времени (от ближайших к самым дальним)
-        sorted_tasks = sorted(tasks.values(), key=lambda x: x['time'])
-
+        user_tz = context.user_data.get('timezone', 'UTC')
         message = "📝 <b>Ваши запланированные задачи:</b>\n\n"
-        for idx, task in enumerate(sorted_tasks, start=1):
+        for idx, (task_id, description, epoch) in enumerate(tasks, start=1):
             message += (
-                f"{idx}. <b>{task['description']}</b> - <i>{task['time'].strftime('%Y-%m-%d %H:%M:%S')}</i>\n"
+                f"{idx}. <b>{description}</b> - <i>{_fmt_ymdhms(epoch, user_tz)}</i>\n"
             )
         await query.message.reply_text(message, parse_mode=ParseMode.HTML, reply_markup=main_menu())
 
     elif query.data == 'delete_task':
-        tasks = user_tasks.get(user_id, {})
+        tasks = await db_get_tasks(user_id)
         if not tasks:
             await query.message.reply_text("📭 У вас нет запланированных задач для удаления.", reply_markup=main_menu())
             return
 
         keyboard = []
-        for task in tasks.values():
-            button_text = f"🗑 {task['description']}"
-            keyboard.append([InlineKeyboardButton(button_text, callback_data=f'delete_{task["id"]}')])
+        for task_id, description, epoch in tasks:
+            button_text = f"🗑 {description}"
+            # Задача передаётся в callback_data как объект (arbitrary_callback_data),
+            # без упаковки id в строку и обратного парсинга
+            keyboard.append([InlineKeyboardButton(button_text, callback_data={'id': task_id, 'description': description})])
 
         reply_markup = InlineKeyboardMarkup(keyboard)
         await query.message.reply_text("Выберите задачу для удаления:", reply_markup=reply_markup)
@@ -300,15 +484,8 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.message.reply_text("⚙️ <b>Дополнительные опции:</b>", parse_mode=ParseMode.HTML, reply_markup=more_menu())
 
     elif query.data == 'instructions':
-        instructions = (
-            "📋 <b>Инструкции по использованию бота:</b>\n\n"
-            "1. <b>Добавление задачи:</b> Напишите любую задачу вместе со временем, когда нужно напомнить. Пример: 'Встреча с командой завтра в 15:00' или 'Пробежка через час'.\n"
-            "2. <b>Просмотр задач:</b> Нажмите кнопку '📋 Просмотреть задачи', чтобы увидеть все свои запланированные задачи.\n"
-            "3. <b>Удаление задачи:</b> Нажмите кнопку '🗑 Удалить задачу' и выберите задачу, которую хотите удалить.\n"
-            "4. <b>Дополнительные настройки:</b> В разделе '➕ Ещё' вы можете изменить свой часовой пояс или снова просмотреть инструкции.\n\n"
-        )
         await query.message.reply_text(
-            instructions,
+            _INSTRUCTIONS,
             parse_mode=ParseMode.HTML,
             reply_markup=main_menu()
         )
@@ -324,10 +501,9 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.message.reply_text("🌍 В каком городе вы находитесь?")
         return CHANGE_TIMEZONE
 
-    elif query.data.startswith('delete_'):
-        task_id = query.data.split('_')[1]
-        tasks = user_tasks.get(user_id, {})
-        task = tasks.get(task_id)
+    elif isinstance(query.data, dict):
+        task_id = query.data['id']
+        task = await db_get_task(user_id, task_id)
 
         if task:
             # Запоминаем ID задачи для подтверждения
@@ -340,7 +516,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup = InlineKeyboardMarkup(confirmation_keyboard)
 
             await query.message.reply_text(
-                f"Вы уверены, что хотите удалить задачу '{task['description']}'?",
+                f"Вы уверены, что хотите удалить задачу '{task[1]}'?",
                 reply_markup=reply_markup
             )
 
@@ -360,20 +536,19 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
 
-        tasks = user_tasks.get(user_id, {})
-        task = tasks.get(task_id)
+        task = await db_get_task(user_id, task_id)
 
         if task:
             # Удаление задачи из хранилища
-            del tasks[task_id]
+            await db_delete_task(user_id, task_id)
 
-            # Удаление задачи из очереди
-            current_jobs = context.job_queue.get_jobs_by_name(task_id)
-            for job in current_jobs:
+            # Удаление напоминания из очереди
+            job = _jobs.pop(task_id, None)
+            if job:
                 job.schedule_removal()
 
             await query.message.reply_text(
-                f"✅ Задача '{task['description']}' удалена.",
+                f"✅ Задача '{task[1]}' удалена.",
                 reply_markup=main_menu()
             )
             logger.info(f"Задача {task_id} пользователя {user_id} удалена.")
@@ -396,6 +571,16 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     return ConversationHandler.END
 
+# Обработка нажатий на устаревшие кнопки: callback-данные хранятся в памяти
+# и не переживают перезапуск бота (или вытеснение из кэша)
+async def invalid_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    await query.message.reply_text(
+        "⚠ Это меню устарело. Пожалуйста, воспользуйтесь кнопками ниже.",
+        reply_markup=main_menu()
+    )
+
 # Обработка сообщений от пользователя (задачи)
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -413,14 +598,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     timezone_str = user_data['timezone']
-    user_timezone = pytz.timezone(timezone_str)
+    user_timezone = _tz(timezone_str)
 
     # Текущее время пользователя
     now = datetime.now(user_timezone)
-    logger.info(f"Текущее время пользователя {user_id}: {now.strftime('%Y-%m-%d %H:%M:%S')}")
+    logger.info(f"Текущее время пользователя {user_id}: {_fmt_dt(now)}")
 
     # Извлечение задачи и времени с помощью GPT
-    task_description, task_time_str = extract_task_and_time(message, now)
+    task_description, task_time_str = await extract_task_and_time(message, now)
 
     if not task_description or not task_time_str:
         await update.message.reply_text(
@@ -431,9 +616,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Парсинг времени
     try:
-        task_time = datetime.strptime(task_time_str, '%Y-%m-%d %H:%M:%S')
+        task_time = ciso8601.parse_datetime_as_naive(task_time_str)
         task_time = user_timezone.localize(task_time)
-        logger.info(f"Распознанное время задачи: {task_time.strftime('%Y-%m-%d %H:%M:%S')}")
+        logger.info(f"Распознанное время задачи: {_fmt_dt(task_time)}")
     except ValueError:
         await update.message.reply_text(
             "❌ Не удалось распознать формат времени. Пожалуйста, используйте формат YYYY-MM-DD HH:MM:SS.",
@@ -450,33 +635,26 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Создание уникального ID задачи
-    task_id = str(uuid.uuid4())[:8]
-
-    # Создание задачи
-    task = {
-        'id': task_id,
-        'description': task_description,
-        'time': task_time
-    }
-
-    # Добавление задачи в хранилище
-    if user_id not in user_tasks:
-        user_tasks[user_id] = {}
-    user_tasks[user_id][task_id] = task
-
-    # Планирование напоминания
-    context.job_queue.run_once(
+    task_id = secrets.token_urlsafe(6)
+
+    # Добавление задачи в хранилище (время храним как UTC epoch)
+    await db_add_task(user_id, task_id, task_description, int(task_time.timestamp()), timezone_str)
+
+    # Планирование напоминания: передаём абсолютное время напрямую,
+    # без пересчёта в относительную задержку (и без дрейфа от него)
+    _jobs[task_id] = context.job_queue.run_once(
         send_reminder,
-        when=(task_time - now).total_seconds(),
+        when=task_time,
         data={'user_id': user_id, 'task_id': task_id},
-        name=task_id
+        name=task_id,
+        user_id=user_id
     )
 
     # Подтверждение пользователю
     confirmation_message = (
         f"✅ <b>Задача добавлена!</b>\n\n"
         f"📝 <b>Задача:</b> {task_description}\n"
-        f"🕒 <b>Время:</b> {task_time.strftime('%Y-%m-%d %H:%M:%S')}"
+        f"🕒 <b>Время:</b> {_fmt_dt(task_time)}"
     )
     await update.message.reply_text(
         confirmation_message,
@@ -490,13 +668,18 @@ async def send_reminder(context: ContextTypes.DEFAULT_TYPE):
     user_id = job.data['user_id']
     task_id = job.data['task_id']
 
-    task = user_tasks.get(user_id, {}).get(task_id)
+    task = await db_get_task(user_id, task_id)
 
     if task:
+        # Отображаем время в актуальном часовом поясе пользователя;
+        # если он неизвестен (например, после перезапуска) — в поясе,
+        # сохранённом при создании задачи
+        user_data = context.user_data or {}
+        user_tz = user_data.get('timezone') or task[3]
         reminder_message = (
             f"⏰ <b>Напоминание:</b>\n\n"
-            f"📝 <b>Задача:</b> {task['description']}\n"
-            f"🕒 <b>Время:</b> {task['time'].strftime('%Y-%m-%d %H:%M:%S')}"
+            f"📝 <b>Задача:</b> {task[1]}\n"
+            f"🕒 <b>Время:</b> {_fmt_ymdhms(task[2], user_tz)}"
         )
         try:
             await context.bot.send_message(
@@ -509,7 +692,10 @@ async def send_reminder(context: ContextTypes.DEFAULT_TYPE):
             logger.error(f"Ошибка при отправке напоминания: {e}")
 
         # Удаление выполненной задачи
-        del user_tasks[user_id][task_id]
+        await db_delete_task(user_id, task_id)
+
+    # Задача выполнена — ссылка на Job больше не нужна
+    _jobs.pop(task_id, None)
 
 # Функция для отмены текущей операции
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -539,7 +725,23 @@ if __name__ == '__main__':
         logger.error("❌ Ошибка: TELEGRAM_TOKEN не установлен в .env файле.")
         exit(1)
 
-    application = ApplicationBuilder().token(TOKEN).build()
+    # uvloop заметно ускоряет event loop на Linux; на платформах без него
+    # остаётся стандартный цикл asyncio
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
+    application = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .arbitrary_callback_data(True)
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, overall_time_period=1, max_retries=3))
+        .post_init(init_db)
+        .post_shutdown(close_db)
+        .build()
+    )
 
     # Определение ConversationHandler для установки часового пояса при запуске
     conv_handler_setup_timezone = ConversationHandler(
@@ -572,6 +774,7 @@ if __name__ == '__main__':
     # Добавление обработчиков
     application.add_handler(conv_handler_setup_timezone)
     application.add_handler(conv_handler_change_timezone)
+    application.add_handler(CallbackQueryHandler(invalid_button_handler, pattern=InvalidCallbackData))
     application.add_handler(CallbackQueryHandler(button_handler))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     application.add_handler(CommandHandler('cancel', cancel))  # Обработчик команды /cancel